@@ -1,12 +1,54 @@
 import streamlit as st
-from tesla_client import TeslaAPIClient
 import json
 import secrets
-import requests
 from datetime import datetime
-import pickle
 import os
-from urllib.parse import parse_qs, quote_plus
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING
+from urllib.parse import parse_qs, quote_plus, urlencode
+
+# tesla_client pulls in requests; import it only once a Tesla call is actually made
+if TYPE_CHECKING:
+    from tesla_client import TeslaAPIClient
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# File to store user tokens
+TOKENS_FILE = "user_tokens.json"
+
+# Public URL of the deployed app, used in the Siri Shortcut instructions
+APP_URL = "https://tesla-address-bruasimwspiycwhw6ia6qk.streamlit.app"
+
+# Tesla app credentials, read once instead of on every request
+try:
+    CLIENT_ID = st.secrets["TESLA_CLIENT_ID"]
+    CLIENT_SECRET = st.secrets["TESLA_CLIENT_SECRET"]
+except (KeyError, FileNotFoundError):
+    CLIENT_ID = CLIENT_SECRET = None
+
+# Show OAuth debug output in the UI only when explicitly enabled
+DEBUG = bool(os.getenv("TESLA_APP_DEBUG"))
+
+@st.cache_resource
+def _load_tokens() -> dict:
+    """Load the token store once per process; the dict is shared and mutated in place"""
+    if os.path.exists(TOKENS_FILE):
+        try:
+            with open(TOKENS_FILE, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable token file: {e}")
+    return {}
+
+@st.cache_resource
+def _tokens_lock() -> threading.RLock:
+    """Guards the shared token dict, which every session's script thread can touch"""
+    return threading.RLock()
 
 # Initialize session state
 if 'authenticated' not in st.session_state:
@@ -14,15 +56,47 @@ if 'authenticated' not in st.session_state:
 if 'client' not in st.session_state:
     st.session_state.client = None
 if 'user_tokens' not in st.session_state:
-    st.session_state.user_tokens = {}
+    st.session_state.user_tokens = _load_tokens()
 
-# File to store user tokens
-TOKENS_FILE = "user_tokens.pkl"
+@st.cache_resource(max_entries=32)
+def _cached_client(username: str) -> "TeslaAPIClient":
+    """Build one Tesla client per user and reuse it across requests"""
+    from tesla_client import TeslaAPIClient
+
+    client = TeslaAPIClient(CLIENT_ID, CLIENT_SECRET)
+    client.on_tokens_refreshed = lambda *tokens: store_refreshed_tokens(username, *tokens)
+    return client
+
+def get_client(username: str) -> "TeslaAPIClient":
+    """Return the cached client for a user, synced with their stored tokens"""
+    client = _cached_client(username)
+    with _tokens_lock():
+        user_data = st.session_state.user_tokens[username]
+        stored_expires_at = user_data.get('expires_at')
+        # Never replace a pair the client just refreshed with an older stored one
+        is_newer = (
+            client.expires_at is None
+            or (stored_expires_at is not None and stored_expires_at > client.expires_at)
+        )
+        if client.access_token != user_data['access_token'] and is_newer:
+            client.set_tokens(
+                user_data['access_token'],
+                user_data['refresh_token'],
+                stored_expires_at
+            )
+        client.vehicle_id = user_data['vehicle_id']
+    return client
 
-# Load existing tokens
-if os.path.exists(TOKENS_FILE):
-    with open(TOKENS_FILE, 'rb') as f:
-        st.session_state.user_tokens = pickle.load(f)
+def store_refreshed_tokens(username: str, access_token: str, refresh_token: str, expires_at: float):
+    """Persist a token pair that the client refreshed on its own"""
+    with _tokens_lock():
+        user_data = st.session_state.user_tokens.get(username)
+        if user_data is None:
+            return
+        user_data['access_token'] = access_token
+        user_data['refresh_token'] = refresh_token
+        user_data['expires_at'] = expires_at
+        save_tokens()
 
 def handle_navigation_request(username: str, destination: str):
     """Handle navigation requests from both UI and API"""
@@ -30,21 +104,19 @@ def handle_navigation_request(username: str, destination: str):
         if username not in st.session_state.user_tokens:
             return {"error": "User not authenticated"}
             
-        user_data = st.session_state.user_tokens[username]
-        client = TeslaAPIClient(
-            st.secrets["TESLA_CLIENT_ID"],
-            st.secrets["TESLA_CLIENT_SECRET"]
-        )
-        client.set_tokens(user_data['access_token'], user_data['refresh_token'])
-        client.vehicle_id = user_data['vehicle_id']
-        
-        # Wake up vehicle
-        client.wake_vehicle()
+        client = get_client(username)
         
-        # Send navigation request
-        response = client.navigate_to_address(destination)
+        if client.recently_succeeded():
+            # The car was driving a few minutes ago, so try the command before waking it
+            response = client.navigate_to_address(destination)
+            if client.is_vehicle_unavailable(response):
+                client.wake_vehicle()
+                response = client.navigate_to_address(destination)
+        else:
+            client.wake_vehicle()
+            response = client.navigate_to_address(destination)
         
-        if response.get('response', {}).get('result') == True:
+        if (response.get('response') or {}).get('result') == True:
             return {"status": "success", "message": f"Navigation request sent successfully to: {destination}"}
         else:
             return {"error": f"Navigation request failed: {response}"}
@@ -52,9 +124,53 @@ def handle_navigation_request(username: str, destination: str):
     except Exception as e:
         return {"error": str(e)}
 
+def _write_tokens(data: str):
+    """Write serialized tokens to disk, replacing the old file atomically"""
+    tmp_file = f"{TOKENS_FILE}.tmp"
+    # Hold an exclusive lock so two app processes never interleave writes to the temp file
+    with open(f"{TOKENS_FILE}.lock", 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+        os.replace(tmp_file, TOKENS_FILE)
+
+def _token_writer_loop(pending: queue.Queue):
+    while True:
+        data = pending.get()
+        try:
+            _write_tokens(data)
+        except OSError as e:
+            print(f"Failed to save tokens: {e}")
+
+@st.cache_resource
+def _token_writer() -> queue.Queue:
+    """Start one background writer per process; it only ever holds the latest snapshot"""
+    pending = queue.Queue(maxsize=1)
+    threading.Thread(target=_token_writer_loop, args=(pending,), daemon=True).start()
+    return pending
+
 def save_tokens():
-    with open(TOKENS_FILE, 'wb') as f:
-        pickle.dump(st.session_state.user_tokens, f)
+    """Queue the current tokens to be written to disk in the background"""
+    pending = _token_writer()
+    # Snapshot and enqueue under one lock so snapshots reach the writer in the order they were taken
+    with _tokens_lock():
+        data = json.dumps(st.session_state.user_tokens, separators=(",", ":"))
+        while True:
+            try:
+                pending.put_nowait(data)
+                return
+            except queue.Full:
+                # Drop the older unwritten snapshot in favour of this one
+                try:
+                    pending.get_nowait()
+                except queue.Empty:
+                    pass
+
+@st.cache_resource
+def _pending_auth() -> dict:
+    """OAuth state values awaiting their callback, keyed by username; kept in memory only"""
+    return {}
 
 def start_tesla_auth(username: str):
     """Start Tesla OAuth flow"""
@@ -63,52 +179,49 @@ def start_tesla_auth(username: str):
         return
         
     state = secrets.token_urlsafe(16)
-    st.write("Generated State:", state)  # Debug info
+    if DEBUG:
+        st.write("Generated State:", state)
     
-    # Store state in user_tokens instead of session_state
-    if 'pending_auth' not in st.session_state.user_tokens:
-        st.session_state.user_tokens['pending_auth'] = {}
-    st.session_state.user_tokens['pending_auth'][username] = state
-    save_tokens()  # Persist to disk
+    # The OAuth redirect starts a new session, so keep the state per process rather than
+    # in session_state; it is short-lived and never written to the token file
+    _pending_auth()[username] = state
     
     redirect_uri = "https://33sticks-labs.com/auth/callback/"
     
     auth_params = {
-        'client_id': st.secrets["TESLA_CLIENT_ID"],
+        'client_id': CLIENT_ID,
         'redirect_uri': redirect_uri,
         'response_type': 'code',
         'scope': 'openid offline_access vehicle_device_data vehicle_cmds',
         'state': state
     }
     
-    # Construct auth URL, encoding each parameter individually
     base_url = "https://auth.tesla.com/oauth2/v3/authorize"
-    params = []
-    for key, value in auth_params.items():
-        encoded_value = quote_plus(str(value))
-        params.append(f"{key}={encoded_value}")
-    
-    auth_url = f"{base_url}?{'&'.join(params)}"
-    st.write("Auth URL:", auth_url)  # Debug info
+    auth_url = f"{base_url}?{urlencode(auth_params, quote_via=quote_plus)}"
+    if DEBUG:
+        st.write("Auth URL:", auth_url)
     
     st.markdown(f'<a href="{auth_url}" target="_self">Click here to authenticate with Tesla</a>', unsafe_allow_html=True)
 
 def handle_tesla_callback(username: str):
     """Handle Tesla OAuth callback"""
+    import requests
+    from tesla_client import TeslaAPIClient
+
     try:
         if not username:
             st.error("Username is required for authentication")
             return False
             
-        # Debug information
-        st.write("Query Parameters:", dict(st.query_params))
+        if DEBUG:
+            st.write("Query Parameters:", dict(st.query_params))
         
         code = st.query_params.get('code')
         state = st.query_params.get('state')
         
-        # Get stored state from user_tokens
-        expected_state = st.session_state.user_tokens.get('pending_auth', {}).get(username)
-        st.write("Expected State:", expected_state)
+        expected_state = _pending_auth().get(username)
+        if DEBUG:
+            st.write("Expected State:", expected_state)
         
         if code and state:
             if state != expected_state:
@@ -122,8 +235,8 @@ def handle_tesla_callback(username: str):
                 'https://auth.tesla.com/oauth2/v3/token',
                 data={
                     'grant_type': 'authorization_code',
-                    'client_id': st.secrets["TESLA_CLIENT_ID"],
-                    'client_secret': st.secrets["TESLA_CLIENT_SECRET"],
+                    'client_id': CLIENT_ID,
+                    'client_secret': CLIENT_SECRET,
                     'code': code,
                     'redirect_uri': redirect_uri
                 }
@@ -131,11 +244,9 @@ def handle_tesla_callback(username: str):
             
             tokens = response.json()
             
-            client = TeslaAPIClient(
-                st.secrets["TESLA_CLIENT_ID"],
-                st.secrets["TESLA_CLIENT_SECRET"]
-            )
-            client.set_tokens(tokens['access_token'], tokens['refresh_token'])
+            client = TeslaAPIClient(CLIENT_ID, CLIENT_SECRET)
+            expires_at = time.time() + tokens['expires_in']
+            client.set_tokens(tokens['access_token'], tokens['refresh_token'], expires_at)
             
             # Get vehicle ID
             vehicle_id = client.get_first_vehicle()
@@ -144,17 +255,17 @@ def handle_tesla_callback(username: str):
             user_data = {
                 'access_token': tokens['access_token'],
                 'refresh_token': tokens['refresh_token'],
+                'expires_at': expires_at,
                 'vehicle_id': vehicle_id,
                 'timestamp': datetime.now().isoformat()
             }
             
-            st.session_state.user_tokens[username] = user_data
+            with _tokens_lock():
+                st.session_state.user_tokens[username] = user_data
+                save_tokens()
             
             # Clean up the pending auth state
-            if 'pending_auth' in st.session_state.user_tokens and username in st.session_state.user_tokens['pending_auth']:
-                del st.session_state.user_tokens['pending_auth'][username]
-            
-            save_tokens()
+            _pending_auth().pop(username, None)
             
             st.session_state.authenticated = True
             st.session_state.client = client
@@ -167,6 +278,25 @@ def handle_tesla_callback(username: str):
         st.error(f"Authentication failed: {str(e)}")
         return False
 
+@st.cache_data
+def _shortcut_markdown(username: str, app_url: str) -> str:
+    """Siri Shortcut setup instructions for a user"""
+    return f"""
+        ### How to set up Siri Shortcuts:
+        1. Open the Shortcuts app on your iPhone
+        2. Create a new shortcut
+        3. Add 'Get Contents of URL' action
+        4. Set the URL to: `{app_url}/?api=true&username={username}&destination=`
+        5. Add a Text action before the URL action
+        6. Set the Text action to ask for the destination
+        7. Add 'URL Encode' action after the Text action
+        8. Add 'Combine Text' action to join:
+           - The base URL above
+           - The encoded destination text
+        9. Set the combined URL as input to 'Get Contents of URL'
+        10. Add a Siri phrase like "Navigate Tesla to..."
+        """
+
 def main():
     st.title("Tesla Navigation App")
     
@@ -179,10 +309,8 @@ def main():
             st.rerun()  # Updated from experimental_rerun()
         st.stop()  # Don't proceed until we have a username
     
-    # Debug information
-    st.write("Full Session State:", {k: v for k, v in st.session_state.items() if k != 'client'})
-    st.write("User Tokens State:", st.session_state.user_tokens)
-    st.write("Current Query Parameters:", dict(st.query_params))
+    if DEBUG:
+        st.write("Current Query Parameters:", dict(st.query_params))
 
     # Check for OAuth callback
     if 'code' in st.query_params:
@@ -194,13 +322,7 @@ def main():
     if st.session_state.username in st.session_state.user_tokens and not st.session_state.authenticated:
         user_data = st.session_state.user_tokens[st.session_state.username]
         if isinstance(user_data, dict) and 'access_token' in user_data:  # Verify it's a valid token entry
-            client = TeslaAPIClient(
-                st.secrets["TESLA_CLIENT_ID"],
-                st.secrets["TESLA_CLIENT_SECRET"]
-            )
-            client.set_tokens(user_data['access_token'], user_data['refresh_token'])
-            client.vehicle_id = user_data['vehicle_id']
-            st.session_state.client = client
+            st.session_state.client = get_client(st.session_state.username)
             st.session_state.authenticated = True
 
     if not st.session_state.authenticated:
@@ -211,9 +333,10 @@ def main():
     # Show authenticated user
     st.sidebar.success(f"Connected as: {st.session_state.username}")
     if st.sidebar.button("Disconnect Account"):
-        if st.session_state.username in st.session_state.user_tokens:
-            del st.session_state.user_tokens[st.session_state.username]
-            save_tokens()
+        with _tokens_lock():
+            if st.session_state.username in st.session_state.user_tokens:
+                del st.session_state.user_tokens[st.session_state.username]
+                save_tokens()
         st.session_state.authenticated = False
         st.session_state.client = None
         st.rerun()  # Updated from experimental_rerun()
@@ -234,22 +357,7 @@ def main():
 
     # Add API endpoint information
     with st.expander("Set up Siri Shortcuts"):
-        app_url = "https://tesla-address-bruasimwspiycwhw6ia6qk.streamlit.app"
-        st.markdown(f"""
-        ### How to set up Siri Shortcuts:
-        1. Open the Shortcuts app on your iPhone
-        2. Create a new shortcut
-        3. Add 'Get Contents of URL' action
-        4. Set the URL to: `{app_url}/?api=true&username={st.session_state.username}&destination=`
-        5. Add a Text action before the URL action
-        6. Set the Text action to ask for the destination
-        7. Add 'URL Encode' action after the Text action
-        8. Add 'Combine Text' action to join:
-           - The base URL above
-           - The encoded destination text
-        9. Set the combined URL as input to 'Get Contents of URL'
-        10. Add a Siri phrase like "Navigate Tesla to..."
-        """)
+        st.markdown(_shortcut_markdown(st.session_state.username, APP_URL))
 
 if __name__ == "__main__":
     main()
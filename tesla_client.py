@@ -1,23 +1,75 @@
 # tesla_client.py
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import threading
 import time
 from typing import Optional, Dict, Any
 
+# Fixed fields of every navigation_request payload
+NAVIGATION_PAYLOAD_TEMPLATE = {
+    "type": "share_ext_content_raw",
+    "locale": "en-US"
+}
+
 class TeslaAPIClient:
     def __init__(self, client_id: str, client_secret: str):
         self.client_id = client_id
         self.client_secret = client_secret
         self.access_token = None
         self.refresh_token = None
+        self.expires_at = None
         self.vehicle_id = None
+        # Called with (access_token, refresh_token, expires_at) after a refresh so the caller can persist the new pair
+        self.on_tokens_refreshed = None
+        # The client is shared between sessions; only one of them may spend the refresh token
+        self._refresh_lock = threading.Lock()
+        # Monotonic time until which the vehicle is assumed to still be awake
+        self._online_until = 0
+        # Wall-clock time of the last command the vehicle accepted
+        self._last_success = 0.0
         self.base_url = "https://fleet-api.prd.na.vn.cloud.tesla.com/api/1"
+        # Reuse one connection to the fleet API instead of a new TLS handshake per call
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
-    def set_tokens(self, access_token: str, refresh_token: str):
+    def set_tokens(self, access_token: str, refresh_token: str, expires_at: Optional[float] = None):
         """Set authentication tokens directly"""
         self.access_token = access_token
         self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.session.headers.update(self.headers)
+
+    def refresh_access_token(self):
+        """Exchange the refresh token for a new token pair"""
+        response = requests.post(
+            "https://auth.tesla.com/oauth2/v3/token",
+            data={
+                'grant_type': 'refresh_token',
+                'client_id': self.client_id,
+                'refresh_token': self.refresh_token
+            }
+        )
+        response.raise_for_status()
+        tokens = response.json()
+        # Tesla invalidates the old refresh token, so always take the new one
+        access_token = tokens['access_token']
+        refresh_token = tokens['refresh_token']
+        expires_at = time.time() + tokens['expires_in']
+        self.set_tokens(access_token, refresh_token, expires_at)
+        # Hand over the new pair itself; another thread may change the client's tokens meanwhile
+        if self.on_tokens_refreshed:
+            self.on_tokens_refreshed(access_token, refresh_token, expires_at)
+
+    def _ensure_fresh(self):
+        """Refresh the access token if it expires within a minute"""
+        if self.expires_at is None or time.time() <= self.expires_at - 60:
+            return
+        with self._refresh_lock:
+            # Another caller may have refreshed while we waited for the lock
+            if time.time() > self.expires_at - 60:
+                self.refresh_access_token()
 
     def get_first_vehicle(self) -> str:
         """Get first vehicle ID from account"""
@@ -29,49 +81,86 @@ class TeslaAPIClient:
 
     @property
     def headers(self) -> Dict[str, str]:
+        # Content-Type is set per request by `json=`
         return {
             "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json"
+            "Accept": "application/json"
         }
 
     def get_vehicles(self) -> Dict[str, Any]:
-        response = requests.get(
-            f"{self.base_url}/vehicles",
-            headers=self.headers
+        self._ensure_fresh()
+        response = self.session.get(
+            f"{self.base_url}/vehicles"
         )
         return response.json()
        
     def wake_vehicle(self) -> bool:
         """Wake up vehicle and wait for it to come online"""
+        if time.monotonic() < self._online_until:
+            return True
+        self._ensure_fresh()
         print("Sending wake up command...")
-        response = requests.post(
-            f"{self.base_url}/vehicles/{self.vehicle_id}/wake_up",
-            headers=self.headers
+        response = self.session.post(
+            f"{self.base_url}/vehicles/{self.vehicle_id}/wake_up"
         )
        
+        # Poll right away, then back off from 0.5s up to 5s between checks
         attempts = 0
-        max_attempts = 10
+        delay = 0.5
+        deadline = time.monotonic() + 45
        
-        while attempts < max_attempts:
-            print(f"Checking vehicle state... (Attempt {attempts + 1}/{max_attempts})")
-            response = requests.get(
-                f"{self.base_url}/vehicles/{self.vehicle_id}/vehicle_data",
-                headers=self.headers
+        while True:
+            attempts += 1
+            print(f"Checking vehicle state... (Attempt {attempts})")
+            response = self.session.get(
+                f"{self.base_url}/vehicles/{self.vehicle_id}/vehicle_data"
             )
            
             if response.status_code == 200:
                 data = response.json()
                 if 'response' in data and data['response'].get('state') == 'online':
                     print("Vehicle is online!")
+                    self._online_until = time.monotonic() + 60
                     return True
            
-            attempts += 1
-            if attempts < max_attempts:
-                print("Vehicle not ready yet, waiting 5 seconds...")
-                time.sleep(5)
+            if time.monotonic() + delay >= deadline:
+                break
+            print(f"Vehicle not ready yet, waiting {delay:.1f} seconds...")
+            time.sleep(delay)
+            delay = min(delay * 1.7, 5.0)
        
         raise Exception("Failed to wake vehicle after maximum attempts")
        
+    def _send_command(self, command: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = self.session.post(
+            f"{self.base_url}/vehicles/{self.vehicle_id}/command/{command}",
+            json=payload
+        )
+        # Timeouts and server errors usually mean the vehicle went back to sleep
+        if response.status_code == 408 or response.status_code >= 500:
+            self._online_until = 0
+        try:
+            data = response.json()
+        except ValueError:
+            # Gateway timeouts and server errors do not always come back as JSON
+            data = {"response": None, "error": response.text or f"HTTP {response.status_code}"}
+        # Keep the status with the result; the shared client may send other commands meanwhile
+        data['status_code'] = response.status_code
+        if (data.get('response') or {}).get('result') == True:
+            self._last_success = time.time()
+        return data
+
+    def recently_succeeded(self, window: float = 600) -> bool:
+        """Whether a command went through within the last `window` seconds"""
+        return time.time() - self._last_success < window
+
+    @staticmethod
+    def is_vehicle_unavailable(response: Dict[str, Any]) -> bool:
+        """Whether a command response says the vehicle is asleep or offline"""
+        if response.get('status_code') == 408:
+            return True
+        return str(response.get('error') or '').startswith('vehicle unavailable')
+
     def navigate_to_coords(self, lat: float, lon: float) -> Dict[str, Any]:
         payload = {
             "lat": lat,
@@ -79,34 +168,22 @@ class TeslaAPIClient:
             "order": 0
         }
        
-        response = requests.post(
-            f"{self.base_url}/vehicles/{self.vehicle_id}/command/navigation_gps_request",
-            headers=self.headers,
-            json=payload
-        )
-        return response.json()
+        return self._send_command("navigation_gps_request", payload)
 
     def navigate_to_address(self, address: str) -> Dict[str, Any]:
         """Send navigation command using address string"""
-        payload = {
-            "type": "share_ext_content_raw",
-            "value": {
-                "android.intent.extra.TEXT": address
-            },
-            "locale": "en-US",
-            "timestamp_ms": str(int(time.time() * 1000))
-        }
-       
-        response = requests.post(
-            f"{self.base_url}/vehicles/{self.vehicle_id}/command/navigation_request",
-            headers=self.headers,
-            json=payload
+        self._ensure_fresh()
+        payload = dict(
+            NAVIGATION_PAYLOAD_TEMPLATE,
+            value={"android.intent.extra.TEXT": address},
+            timestamp_ms=str(time.time_ns() // 1_000_000)
         )
-        return response.json()
+       
+        return self._send_command("navigation_request", payload)
 
     def get_vehicle_data(self) -> Dict[str, Any]:
-        response = requests.get(
-            f"{self.base_url}/vehicles/{self.vehicle_id}/vehicle_data",
-            headers=self.headers
+        self._ensure_fresh()
+        response = self.session.get(
+            f"{self.base_url}/vehicles/{self.vehicle_id}/vehicle_data"
         )
         return response.json()
\ No newline at end of file